@@ -209,7 +209,7 @@ def handle_candidate_sets(data):
     )
 
 
-def handle_recommendations(data):
+def _handle_user_recommendations(data):
     """ Take recommended recordings for a user and save it in the db.
     """
     user_id = data['user_id']
@@ -235,6 +235,18 @@ def handle_recommendations(data):
     current_app.logger.debug("Running post recommendation steps for user {}".format(user["musicbrainz_id"]))
 
 
+def handle_recommendations(message):
+    """ Take recommended recordings for a batch of users and save them in the db.
+    """
+    for data in message['data']:
+        # an error for one user should not prevent saving the recommendations of the rest of the batch
+        try:
+            _handle_user_recommendations(data)
+        except Exception:
+            current_app.logger.error("Error while inserting recommendations for user: %s", data.get('user_id'),
+                                     exc_info=True)
+
+
 def handle_fresh_releases(message):
     try:
         insert_fresh_releases(message["database"], message["data"])
@@ -328,44 +328,106 @@ class HandlersTestCase(DatabaseTestCase):
     @mock.patch('listenbrainz.spark.handlers.db_recommendations_cf_recording.insert_user_recommendation')
     @mock.patch('listenbrainz.spark.handlers.db_user.get')
     def test_handle_recommendations(self, mock_get, mock_db_insert):
+        recommendations_1 = {
+            'top_artist': [
+                {
+                    'recording_mbid': "2acb406f-c716-45f8-a8bd-96ca3939c2e5",
+                    'score': 1.8
+                },
+                {
+                    'recording_mbid': "8acb406f-c716-45f8-a8bd-96ca3939c2e5",
+                    'score': -0.8
+                }
+            ],
+            'similar_artist': []
+        }
+        recommendations_2 = {
+            'top_artist': [
+                {
+                    'recording_mbid': "3acb406f-c716-45f8-a8bd-96ca3939c2e5",
+                    'score': 0.5
+                }
+            ],
+            'similar_artist': []
+        }
         data = {
-            'user_id': 1,
             'type': 'cf_recording_recommendations',
-            'recommendations': {
-                'top_artist': [
-                    {
-                        'recording_mbid': "2acb406f-c716-45f8-a8bd-96ca3939c2e5",
-                        'score': 1.8
-                    },
-                    {
-                        'recording_mbid': "8acb406f-c716-45f8-a8bd-96ca3939c2e5",
-                        'score': -0.8
-                    }
-                ],
-                'similar_artist': []
-            }
+            'data': [
+                {'user_id': 1, 'recommendations': recommendations_1},
+                # user doesn't exist in the database, should be skipped without affecting the other users
+                {'user_id': 100, 'recommendations': recommendations_1},
+                {'user_id': 2, 'recommendations': recommendations_2}
+            ]
         }
 
-        mock_get.return_value = {'id': 1, 'musicbrainz_id': 'vansika'}
+        users = {
+            1: {'id': 1, 'musicbrainz_id': 'vansika'},
+            2: {'id': 2, 'musicbrainz_id': 'lucifer'}
+        }
+        mock_get.side_effect = lambda user_id: users.get(user_id)
         with self.app.app_context():
             handle_recommendations(data)
 
-        mock_db_insert.assert_called_with(
-            1,
-            UserRecommendationsJson(
-                top_artist=[
-                    UserRecommendationsRecord(
-                        recording_mbid="2acb406f-c716-45f8-a8bd-96ca3939c2e5",
-                        score=1.8
-                    ),
-                    UserRecommendationsRecord(
-                        recording_mbid="8acb406f-c716-45f8-a8bd-96ca3939c2e5",
-                        score=-0.8
-                    ),
-                ],
-                similar_artist=[]
+        mock_db_insert.assert_has_calls([
+            call(
+                1,
+                UserRecommendationsJson(
+                    top_artist=[
+                        UserRecommendationsRecord(
+                            recording_mbid="2acb406f-c716-45f8-a8bd-96ca3939c2e5",
+                            score=1.8
+                        ),
+                        UserRecommendationsRecord(
+                            recording_mbid="8acb406f-c716-45f8-a8bd-96ca3939c2e5",
+                            score=-0.8
+                        ),
+                    ],
+                    similar_artist=[]
+                )
+            ),
+            call(
+                2,
+                UserRecommendationsJson(
+                    top_artist=[
+                        UserRecommendationsRecord(
+                            recording_mbid="3acb406f-c716-45f8-a8bd-96ca3939c2e5",
+                            score=0.5
+                        )
+                    ],
+                    similar_artist=[]
+                )
             )
-        )
+        ])
+        self.assertEqual(mock_db_insert.call_count, 2)
+
+    @mock.patch('listenbrainz.spark.handlers.db_recommendations_cf_recording.insert_user_recommendation')
+    @mock.patch('listenbrainz.spark.handlers.db_user.get')
+    def test_handle_recommendations_error(self, mock_get, mock_db_insert):
+        recommendations = {
+            'top_artist': [
+                {
+                    'recording_mbid': "2acb406f-c716-45f8-a8bd-96ca3939c2e5",
+                    'score': 1.8
+                }
+            ],
+            'similar_artist': []
+        }
+        data = {
+            'type': 'cf_recording_recommendations',
+            'data': [
+                {'user_id': 1, 'recommendations': recommendations},
+                {'user_id': 2, 'recommendations': recommendations}
+            ]
+        }
+
+        mock_get.side_effect = lambda user_id: {'id': user_id, 'musicbrainz_id': f'user_{user_id}'}
+        # an error while inserting the first user's recommendations should not skip the second user
+        mock_db_insert.side_effect = [Exception('database error'), None]
+        with self.app.app_context():
+            handle_recommendations(data)
+
+        self.assertEqual(mock_db_insert.call_count, 2)
+        self.assertEqual(mock_db_insert.call_args_list[1][0][0], 2)
 
     @mock.patch('listenbrainz.troi.daily_jams.get_followers_of_user')
     @mock.patch('listenbrainz.troi.daily_jams.generate_playlist')
@@ -11,12 +11,13 @@ This dataframe is joined with recordings_df on recording_id to get the recording
 
 import logging
 import time
-from collections import defaultdict
 
 import pyspark.sql
+from more_itertools import chunked
 from py4j.protocol import Py4JJavaError
+from pyspark import StorageLevel
 from pyspark.ml.recommendation import ALSModel
-from pyspark.sql.functions import col
+from pyspark.sql.functions import broadcast
 
 import listenbrainz_spark
 from listenbrainz_spark import utils, path
@@ -32,6 +33,14 @@ from listenbrainz_spark.utils import save_parquet
 
 logger = logging.getLogger(__name__)
 
+# each user has up to recommendation_raw_limit (1000 by default) recs, so batch only a
+# few users per message to keep the message size reasonable
+USERS_PER_MESSAGE = 25
+
+# number of users in each partition of the recommendations streamed to the driver, toLocalIterator
+# holds a whole partition in driver memory so keep it well below the driver memory
+USERS_PER_PARTITION = 1000
+
 
 def get_most_recent_model_meta():
     """ Get model id of recently created model.
@@ -76,26 +85,52 @@ def process_recommendations(recommendation_df, limit):
             limit (int): Number of recommendations to be filtered for each user.
 
         Returns:
-            recommendation_df: Dataframe of user_id, recording_mbid, rating and latest_listened_at.
+            recommendation_df: Persisted dataframe of user_id and recs, the caller must unpersist it.
     """
     recommendation_df.createOrReplaceTempView("recommendation")
-    query = f"""
-        WITH ranked_recommendation AS (
-            SELECT spark_user_id
-                 , recording_id
-                 , prediction AS score
-                 , row_number() OVER(PARTITION BY spark_user_id ORDER BY prediction DESC) AS rank
-              FROM recommendation
-        ), distinct_recommendations AS (
-            SELECT u.user_id
+    # filter on rank before the joins so that they only see the top X recommendations for each user
+    top_k_df = run_query(f"""
+        SELECT spark_user_id
+             , recording_id
+             , prediction
+          FROM (
+                SELECT spark_user_id
+                     , recording_id
+                     , prediction
+                     , row_number() OVER(PARTITION BY spark_user_id ORDER BY prediction DESC) AS rank
+                  FROM recommendation
+               )
+         WHERE rank <= {limit}
+    """)
+    return _join_and_collect(top_k_df)
+
+
+def _join_and_collect(recommendation_df):
+    """ Perform steps 2 and 3 of process_recommendations on recommendations that are already
+        limited to the top X recommendations for each user, save them to HDFS and collect the
+        recs of each user.
+
+        Args:
+            recommendation_df: Dataframe of spark_user_id, recording_id and prediction.
+
+        Returns:
+            recommendation_df: Persisted dataframe of user_id and recs, the caller must unpersist it.
+    """
+    recommendation_df.createOrReplaceTempView("top_k")
+    query = """
+        WITH distinct_recommendations AS (
+            -- user only has a row per active user, broadcast it to avoid shuffling the recommendations
+            SELECT /*+ BROADCAST(u) */
+                   u.user_id
                  , r.recording_mbid
-                 , max(score) AS score
-              FROM ranked_recommendation rr
+                 , max(prediction) AS score
+              FROM top_k tk
               JOIN recording r
-                ON r.recording_id = rr.recording_id
+                ON r.recording_id = tk.recording_id
               JOIN user u
-                ON rr.spark_user_id = u.spark_user_id
-             WHERE rank <= {limit}
+                ON tk.spark_user_id = u.spark_user_id
+          -- group on user_id and not spark_user_id, the output is then already partitioned
+          -- on the keys of the recording_discovery join below and needs no further shuffle
           GROUP BY user_id
                  , recording_mbid
         )   SELECT user_id
@@ -107,30 +142,44 @@ def process_recommendations(recommendation_df, limit):
              USING (user_id, recording_mbid)
     """
     df = run_query(query)
+    # persist the joined recommendations so that saving them to HDFS and collecting them below
+    # share a single run of the model and the joins
+    df.persist(StorageLevel.MEMORY_AND_DISK)
     save_parquet(df, RAW_RECOMMENDATIONS)
     df.createOrReplaceTempView("raw_recommendations")
 
     query = """
         SELECT user_id
-             , array_sort(
-                    collect_list(
-                        struct(
-                            recording_mbid
-                          , score
-                          , date_format(latest_listened_at, "yyyy-MM-dd'T'HH:mm:ss.SSS'Z'") AS latest_listened_at
+             -- sort_array compares structs field by field, so putting score first sorts the recs in
+             -- descending order of score without an interpreted comparator lambda. transform then
+             -- restores the field order of the recs.
+             , transform(
+                    sort_array(
+                        collect_list(
+                            struct(
+                                score
+                              , recording_mbid
+                              , date_format(latest_listened_at, "yyyy-MM-dd'T'HH:mm:ss.SSS'Z'") AS latest_listened_at
+                            )
                         )
+                      , false
                     )
-                  , (left, right) -> CASE
-                                     WHEN left.score > right.score THEN -1
-                                     WHEN left.score < right.score THEN  1
-                                     ELSE 0
-                                     END
-                    -- sort in descending order of score
+                  , rec -> named_struct(
+                                'recording_mbid', rec.recording_mbid
+                              , 'score', rec.score
+                              , 'latest_listened_at', rec.latest_listened_at
+                           )
                ) AS recs
           FROM raw_recommendations
       GROUP BY user_id
     """
-    return run_query(query)
+    recs_df = run_query(query)
+    # persist the collected recs so that streaming them to the driver in create_messages doesn't
+    # recompute them, an action must be called to persist data in memory
+    recs_df.persist(StorageLevel.MEMORY_AND_DISK)
+    recs_df.count()
+    df.unpersist()
+    return recs_df
 
 
 def _is_empty_dataframe(df):
@@ -165,6 +214,23 @@ def generate_recommendations(candidate_set: pyspark.sql.DataFrame, model: ALSMod
     return recommendation_df
 
 
+def _filter_users(df, users):
+    """ Filter the dataframe to the rows of the given users.
+
+        A broadcast left semi join is used instead of isin because isin compiles the list
+        into a single predicate evaluated against each row, which gets slow for a large list.
+
+        Args:
+            df: A dataframe having a user_id column.
+            users: list of user ids to keep.
+
+        Returns:
+            df: the rows of the dataframe for the given users.
+    """
+    users_df = listenbrainz_spark.session.createDataFrame([(user,) for user in users], ['user_id'])
+    return df.join(broadcast(users_df), 'user_id', 'left_semi')
+
+
 def get_candidate_set_rdd_for_user(candidate_set_df, users):
     """ Get candidate set RDD for a given user.
 
@@ -176,8 +242,7 @@ def get_candidate_set_rdd_for_user(candidate_set_df, users):
             candidate_set_rdd: An RDD of spark_user_id and recording_id for a given user.
     """
     if users:
-        candidate_set_user_df = candidate_set_df.select('spark_user_id', 'recording_id') \
-                                                .where(col('user_id').isin(users))
+        candidate_set_user_df = _filter_users(candidate_set_df, users).select('spark_user_id', 'recording_id')
     else:
         candidate_set_user_df = candidate_set_df.select('spark_user_id', 'recording_id')
 
@@ -200,9 +265,8 @@ def get_user_name_and_user_id(all_users_df, users):
     if len(users) == 0:
         users_df = all_users_df.select('spark_user_id', 'user_id').distinct()
     else:
-        users_df = all_users_df \
+        users_df = _filter_users(all_users_df, users) \
             .select('spark_user_id', 'user_id') \
-            .where(all_users_df.user_id.isin(users)) \
             .distinct()
 
     if _is_empty_dataframe(users_df):
@@ -222,30 +286,37 @@ def create_messages(model_id, model_html_file, raw_recs_df, active_user_count, t
             total_time (float): Time taken in exceuting the whole script.
 
         Returns:
-            messages: A list of messages to be sent via RabbitMQ
+            messages: A list of messages to be sent via RabbitMQ, each recommendations message
+                contains the recommendations of at most USERS_PER_MESSAGE users.
     """
-    user_rec = defaultdict(lambda: {
-        "raw": []
-    })
-
-    raw_rec_itr = raw_recs_df.toLocalIterator()
+    # toLocalIterator runs a job for each partition. raw_recs_df is persisted so AQE does not coalesce
+    # its shuffle partitions, merge them to avoid running many jobs that only fetch a few rows each.
+    num_partitions = max(1, active_user_count // USERS_PER_PARTITION)
+    raw_rec_itr = raw_recs_df.coalesce(num_partitions).toLocalIterator()
     raw_rec_user_count = 0
-    for row in raw_rec_itr:
-        row_dict = row.asDict(recursive=True)
-        user_rec[row_dict["user_id"]]["raw"] = row_dict["recs"]
-        raw_rec_user_count += 1
-
-    for user_id, data in user_rec.items():
-        messages = {
-            'user_id': user_id,
-            'type': 'cf_recommendations_recording_recommendations',
-            'recommendations': {
-                'raw': data['raw'],
-                'model_id': model_id,
-                'model_url': f"http://michael.metabrainz.org/{model_html_file}"
+    try:
+        for rows in chunked(raw_rec_itr, USERS_PER_MESSAGE):
+            entries = []
+            for row in rows:
+                entries.append({
+                    'user_id': row.user_id,
+                    'recommendations': {
+                        # recs is an array of flat structs, a shallow asDict per rec avoids the reflection
+                        # overhead of converting the entire row with asDict(recursive=True)
+                        'raw': [rec.asDict() for rec in row.recs],
+                        'model_id': model_id,
+                        'model_url': f"http://michael.metabrainz.org/{model_html_file}"
+                    }
+                })
+            raw_rec_user_count += len(entries)
+            yield {
+                'type': 'cf_recommendations_recording_recommendations',
+                'data': entries
             }
-        }
-        yield messages
+    finally:
+        # the recommendations are persisted when generated, release them once all have been sent
+        # or if the consumer stops iterating early
+        raw_recs_df.unpersist()
 
     yield {
         'type': 'cf_recommendations_recording_mail',
@@ -303,7 +374,9 @@ def get_raw_recommendations(model: ALSModel, limit, users_df):
              , rec.rating AS prediction
           FROM expanded_recs
     """)
-    recs_df = process_recommendations(recommendations, limit)
+    # recommendForUserSubset already returns the top X recommendations for each user so
+    # the row_number() window of process_recommendations is not needed
+    recs_df = _join_and_collect(recommendations)
     return recs_df
 
 
@@ -336,10 +409,18 @@ def main(recommendation_raw_limit=None, users=None):
     logger.info('Loading model...')
     model_id, model_html_file = get_most_recent_model_meta()
     model = load_model(model_id)
-
-    # an action must be called to persist data in memory
-    recordings_df.count()
-    recordings_df.persist()
+    # recommendForUserSubset cross joins blocks of user factors with blocks of item factors. Unless a side
+    # is under spark.sql.autoBroadcastJoinThreshold, in which case Spark plans a broadcast nested loop
+    # join, this is a cartesian product that recomputes the item factors for each block of users. keep
+    # them in memory instead of re-reading them from HDFS every time. an action must be called to persist
+    # data in memory
+    model.itemFactors.persist(StorageLevel.MEMORY_AND_DISK)
+    item_count = model.itemFactors.count()
+    # each row of item factors is an int id and an array of rank floats
+    logger.info('Item factors: {} rows, ~{:.2f}MB'.format(item_count, item_count * (model.rank + 1) * 4 / 1024 ** 2))
+
+    # persisted lazily, the first join in process_recommendations populates the cache
+    recordings_df.persist(StorageLevel.MEMORY_AND_DISK)
 
     try:
         # timestamp when the script was invoked
@@ -365,12 +446,12 @@ def main(recommendation_raw_limit=None, users=None):
 
     # persisted data must be cleared from memory after usage to avoid OOM
     recordings_df.unpersist()
+    users_df.unpersist()
+    model.itemFactors.unpersist()
 
     total_time = time.monotonic() - ts_initial
     logger.info('Total time: {:.2f}sec'.format(total_time))
 
     result = create_messages(model_id, model_html_file, raw_recs_df, active_user_count, total_time)
 
-    users_df.unpersist()
-
     return result
@@ -99,6 +99,18 @@ class RecommendTestClass(RecommendationsTestCase):
             ])
         )
 
+        # _join_and_collect assumes the recommendations are limited already so all are kept
+        recommendations = recommend._join_and_collect(recommendation_df)
+        rows_user_1 = recommendations.where(recommendations.user_id == 1).collect()[0]
+        self.assertEqual(
+            [rec.recording_mbid for rec in rows_user_1.recs],
+            [
+                "2acb406f-c716-45f8-a8bd-96ca3939c2e5",
+                "8acb406f-c716-45f8-a8bd-96ca3939c2e5",
+                "3acb406f-c716-45f8-a8bd-96ca3939c2e5"
+            ]
+        )
+
     @patch('listenbrainz_spark.recommendations.recording.recommend.process_recommendations')
     @patch('listenbrainz_spark.recommendations.recording.recommend.listenbrainz_spark')
     def test_generate_recommendations(self, mock_lb, mock_process):
@@ -222,34 +234,37 @@ class RecommendTestClass(RecommendationsTestCase):
         data = recommend.create_messages(model_id, model_html_file, raw_rec_df, active_user_count, total_time)
         self.assertCountEqual(list(data), [
             {
-                'user_id': 3,
                 'type': 'cf_recommendations_recording_recommendations',
-                'recommendations': {
-                    'raw': [
-                        {
-                            'latest_listened_at': '2019-10-12T09:43:57.000Z',
-                            'recording_mbid': '8acb406f-c716-45f8-a8bd-96ca3939c2e5',
-                            'score': -1.0
+                'data': [
+                    {
+                        'user_id': 4,
+                        'recommendations': {
+                            'raw': [
+                                {
+                                    'recording_mbid': "2acb406f-c716-45f8-a8bd-96ca3939c2e5",
+                                    'score': 4.0,
+                                    'latest_listened_at': None
+                                }
+                            ],
+                            'model_id': 'foobar',
+                            'model_url': 'http://michael.metabrainz.org/foobar.html'
                         }
-                    ],
-                    'model_id': 'foobar',
-                    'model_url': 'http://michael.metabrainz.org/foobar.html'
-                }
-            },
-            {
-                'user_id': 4,
-                'type': 'cf_recommendations_recording_recommendations',
-                'recommendations': {
-                    'raw': [
-                        {
-                            'recording_mbid': "2acb406f-c716-45f8-a8bd-96ca3939c2e5",
-                            'score': 4.0,
-                            'latest_listened_at': None
+                    },
+                    {
+                        'user_id': 3,
+                        'recommendations': {
+                            'raw': [
+                                {
+                                    'latest_listened_at': '2019-10-12T09:43:57.000Z',
+                                    'recording_mbid': '8acb406f-c716-45f8-a8bd-96ca3939c2e5',
+                                    'score': -1.0
+                                }
+                            ],
+                            'model_id': 'foobar',
+                            'model_url': 'http://michael.metabrainz.org/foobar.html'
                         }
-                    ],
-                    'model_id': 'foobar',
-                    'model_url': 'http://michael.metabrainz.org/foobar.html'
-                }
+                    }
+                ]
             },
             {
                 'type': 'cf_recommendations_recording_mail',
@@ -259,6 +274,32 @@ class RecommendTestClass(RecommendationsTestCase):
             }
         ])
 
+    def test_create_messages_batches(self):
+        user_count = recommend.USERS_PER_MESSAGE * 2 + 1
+        raw_rec_df = listenbrainz_spark.session.createDataFrame([
+            Row(user_id=user_id, recs=[
+                Row(
+                    latest_listened_at=None,
+                    recording_mbid="2acb406f-c716-45f8-a8bd-96ca3939c2e5",
+                    score=1.0
+                )
+            ])
+            for user_id in range(user_count)
+        ], schema=recommendation_schema)
+
+        messages = list(recommend.create_messages("foobar", "foobar.html", raw_rec_df, user_count, 3600))
+
+        rec_messages = [m for m in messages if m['type'] == 'cf_recommendations_recording_recommendations']
+        self.assertEqual(
+            sorted(len(message['data']) for message in rec_messages),
+            [1, recommend.USERS_PER_MESSAGE, recommend.USERS_PER_MESSAGE]
+        )
+        user_ids = [entry['user_id'] for message in rec_messages for entry in message['data']]
+        self.assertCountEqual(user_ids, list(range(user_count)))
+
+        self.assertEqual(messages[-1]['type'], 'cf_recommendations_recording_mail')
+        self.assertEqual(messages[-1]['raw_rec_user_count'], user_count)
+
     def test_get_user_count(self):
         df = listenbrainz_spark.session.createDataFrame(
             [Row(user_id=3), Row(user_id=3), Row(user_id=2)], schema=None